@@ -1,18 +1,47 @@
-import base64
+import json
+import re
+import sqlite3
+import threading
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 import streamlit as st
-import SessionState
+import numpy as np
 import pandas as pd
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from bs4 import BeautifulSoup, SoupStrainer
+import matplotlib as mpl
 import matplotlib.pyplot as plt
-import matplotlib.path as mpath
-import matplotlib.patches as mpatches
+from matplotlib.path import Path
+from matplotlib.collections import PathCollection
+from matplotlib.font_manager import FontProperties
 from highlight_text import fig_text
 
 
 # ---------- Define functions ----------
 
+mpl.rcParams['agg.path.chunksize'] = 10000
+
+# Marks a matchday that has not been played yet
+TERMINAL_RE = re.compile(r'-:-|news')
+
+CURVE_CODES = np.array([Path.MOVETO] + [Path.CURVE3] * 4, dtype=Path.code_type)
+
+
+@st.cache_resource
+def get_session():
+    '''
+    Returns the HTTP session shared across reruns, so connections to
+    worldfootball.net are reused
+    '''
+    session = requests.Session()
+    session.mount('https://',
+                  HTTPAdapter(pool_connections=1, pool_maxsize=16))
+    session.headers.update({'Accept-Encoding': 'gzip, deflate',
+                            'User-Agent': 'Mozilla/5.0'})
+    return session
+
+
 def get_url(league, season, week=1):
     '''Generates the appropriate URL based on the parameters'''
     league = league_dict.get(league, 'eng-premier-league')
@@ -21,122 +50,189 @@ def get_url(league, season, week=1):
     return url
 
 
+@st.cache_data(ttl=60*60*24, show_spinner=False)
 def get_season_range(league):
     '''
     Returns the first and last season with data available for the selected league.
     '''
     league = league_dict.get(league, 'eng-premier-league')
     url = f'https://www.worldfootball.net/schedule/{league}'
-    page = requests.get(url)
-    soup = BeautifulSoup(page.text, 'html.parser')
-    seasons = soup.find('select', attrs={'name': 'saison'}).find_all('option')
+    page = get_session().get(url, timeout=10)
+    strainer = SoupStrainer('select', attrs={'name': 'saison'})
+    soup = BeautifulSoup(page.text, 'lxml', parse_only=strainer)
+    seasons = soup.find('select').find_all('option')
     first_season = int(seasons[-1].text.split('/')[1])
     last_season = int(seasons[0].text.split('/')[1])
     return first_season, last_season
 
 
-@st.cache(show_spinner=False)
-def scrape_standings(league, season):
+def scrape_week(session, league, season, week):
     '''
-    Returns a DataFrame with the league standings by matchday for a given season
+    Returns the team names ordered by position after a given matchday,
+    or None if the matchday has not been played yet
+    '''
+    url = get_url(league, season, week)
+    page = session.get(url, timeout=10)
+    table_attrs = {'class': 'standard_tabelle'}
+    strainer = SoupStrainer('table', attrs=table_attrs)
+    soup = BeautifulSoup(page.text, 'lxml', parse_only=strainer)
+    schedule_table, standings_table = soup.find_all(
+        'table', attrs=table_attrs)[:2]
+    if (TERMINAL_RE.search(standings_table.find('td').text)
+            or TERMINAL_RE.search(schedule_table.text)):
+        return None
+    return [team.text for team in standings_table.find_all('a')]
+
+
+@st.cache_resource
+def get_cache():
+    '''
+    Returns the connection to the on-disk cache of played matchdays and the
+    lock guarding it, shared across reruns and sessions
     '''
-    week = 1
-    standings = []
-    while True:
-        url = get_url(league, season, week)
-        page = requests.get(url)
-        soup = BeautifulSoup(page.text, 'html.parser')
-        standings_table = soup.find_all(
-            'table', attrs={'class': 'standard_tabelle'})[1]
-        if 'news' in standings_table.find('td').text or '-:-' in page.text:
+    conn = sqlite3.connect('cache.db', check_same_thread=False)
+    conn.execute('CREATE TABLE IF NOT EXISTS gw (league TEXT, season INT, '
+                 'week INT, teams TEXT, PRIMARY KEY (league, season, week))')
+    return conn, threading.Lock()
+
+
+def load_cached_weeks(league, season):
+    '''Returns the team names by matchday stored in the on-disk cache'''
+    conn, lock = get_cache()
+    with lock:
+        rows = conn.execute('SELECT teams FROM gw WHERE league = ? '
+                            'AND season = ? ORDER BY week',
+                            (league, season)).fetchall()
+    return [json.loads(teams) for teams, in rows]
+
+
+def store_cached_weeks(league, season, weeks, first_week, previous=None):
+    '''
+    Writes the team names by matchday to the on-disk cache.
+    Stops at the first matchday with no teams or fewer teams than the one
+    before it, so a page that did not parse properly is scraped again later.
+    '''
+    rows = []
+    for week, teams in enumerate(weeks, start=first_week):
+        if not teams or (previous and len(teams) < len(previous)):
             break
-        else:
-            teams = [team.text for team in standings_table.find_all('a')]
-            standings.append(teams)
-            week += 1
-
-    return pd.DataFrame(standings).T
-
-
-def get_patch(p1, p2, color):
-    '''Creates a smooth path between two points'''
-    Path = mpath.Path
-    x1, y1 = p1
-    x2, y2 = p2
-
-    if y2 > y1:
-        patch = mpatches.PathPatch(
-            Path(
-                [p1,
-                 (x1+(x2-x1)/2, y1),
-                 (x1+(x2-x1)/2, y1 + (y2-y1)/2),
-                 (x1+(x2-x1)/2, y2),
-                 p2],
-                [Path.MOVETO, Path.CURVE3, Path.CURVE3,
-                 Path.CURVE3, Path.CURVE3
-                 ]
-            ),
-            ec=color, fc='none', zorder=5
-        )
-
-    elif y2 < y1:
-        patch = mpatches.PathPatch(
-            Path([p1,
-                  (x1 + (x2-x1)/2, y1),
-                  (x1+(x2-x1)/2, y1+(y2-y1)/2),
-                  (x1 + (x2-x1)/2, y2),
-                  p2],
-                 [Path.MOVETO, Path.CURVE3, Path.CURVE3,
-                 Path.CURVE3, Path.CURVE3]),
-            ec=color, fc='none', zorder=5
-        )
+        rows.append((league, season, week, json.dumps(teams)))
+        previous = teams
+    conn, lock = get_cache()
+    with lock, conn:
+        conn.executemany('INSERT OR REPLACE INTO gw VALUES (?, ?, ?, ?)',
+                         rows)
 
-    else:
-        patch = mpatches.PathPatch(
-            Path([p1, p2],
-                 [Path.MOVETO, Path.LINETO]),
-            ec=color, fc='none', zorder=5
-        )
 
-    return patch
+@st.cache_data(ttl=60*60*6, show_spinner=False)
+def scrape_standings(league, season, batch_size=8):
+    '''
+    Returns a DataFrame with the league standings by matchday for a given season
+    '''
+    # Only matchdays after the last cached one need to be scraped
+    standings = load_cached_weeks(league, season)
+    first_new_week = week = len(standings) + 1
+    finished = False
+    # Look up the session here, worker threads have no Streamlit context
+    session = get_session()
+    with ThreadPoolExecutor(max_workers=batch_size) as executor:
+        while not finished:
+            # Fetch a batch of matchdays concurrently, keep them in order
+            weeks = range(week, week + batch_size)
+            batch = executor.map(
+                lambda w: scrape_week(session, league, season, w), weeks)
+            for teams in batch:
+                if teams is None:
+                    finished = True
+                    break
+                standings.append(teams)
+            week += batch_size
+
+    previous = standings[first_new_week-2] if first_new_week > 1 else None
+    store_cached_weeks(league, season, standings[first_new_week-1:],
+                       first_new_week, previous)
+
+    # Series pad matchdays with fewer teams with NaN
+    return pd.DataFrame({week: pd.Series(teams)
+                         for week, teams in enumerate(standings, start=1)})
+
+
+def get_paths(coords):
+    '''
+    Creates smooth paths between consecutive points.
+    Level segments have collinear control points and render as straight lines.
+    '''
+    p1, p2 = coords[:-1], coords[1:]
+    mx = (p1[:, 0] + p2[:, 0]) / 2
+    my = (p1[:, 1] + p2[:, 1]) / 2
+    verts = np.stack([p1,
+                      np.column_stack([mx, p1[:, 1]]),
+                      np.column_stack([mx, my]),
+                      np.column_stack([mx, p2[:, 1]]),
+                      p2], axis=1)
+    return [Path(v, CURVE_CODES) for v in verts]
 
 
 def draw_plot(league, season, standings, highlight_colors,
-              facecolor, custom_title, subtitle):
+              facecolor, custom_title, subtitle, aspect_ratio):
     num_teams = len(standings)
     num_games = len(standings.columns)
-    team_names = standings.iloc[:, -1].to_list()
+    team_names = list(dict.fromkeys(
+        standings[max(standings.columns)].dropna()))
 
     # Reorder team name list to emphasize highlighted lines
-    for team in highlight_colors.keys():
-        team_names.append(team_names.pop(team_names.index(team)))
+    highlighted = set(highlight_colors)
+    team_names = ([team for team in team_names if team not in highlighted]
+                  + [team for team in team_names if team in highlighted])
+
+    # Matchday and position of every team, sorted by matchday
+    long = (standings.rename_axis('pos').reset_index()
+            .melt(id_vars='pos', var_name='week', value_name='team')
+            .dropna())
+    # Matchdays are numbered from 1, the x-axis starts at 0
+    long['week'] = long['week'].astype(np.int64) - 1
+    long['pos'] = long['pos'].astype(np.int64)
+    coords_by_team = {team: group[['week', 'pos']].to_numpy()
+                      for team, group in long.sort_values('week')
+                                             .groupby('team', sort=False)}
 
     fig, ax = plt.subplots(facecolor=facecolor,
                            figsize=(20, 20*aspect_ratio),
-                           dpi=200)
+                           dpi=100)
+
+    # Lines and dots of all teams, drawn as one collection each
+    paths, path_colors = [], []
+    xs, ys, dot_colors = [], [], []
+    labels = []
 
     for team_name in team_names:
         # Determine text color and fontweight
         color = highlight_colors.get(team_name, 'dimgrey')
         fontweight = 'bold' if color != 'dimgrey' else None
 
-        indices = standings[standings == team_name].stack().index.tolist()
-        coords = [(idx[1], idx[0]) for idx in indices]
-        coords = [(int(coord[0]), coord[1]) for coord in coords]
-        coords = sorted(coords, key=lambda x: x[0])
+        coords = coords_by_team[team_name]
+
+        # Collect paths
+        team_paths = get_paths(coords)
+        paths.extend(team_paths)
+        path_colors.extend([color] * len(team_paths))
 
-        # Plot patches
-        for p1, p2 in zip(coords[:-1], coords[1:]):
-            patch = get_patch(p1, p2, color=color)
-            ax.add_patch(patch)
+        # Collect dots
+        xs.extend(coords[:, 0])
+        ys.extend(coords[:, 1])
+        dot_colors.extend([color] * len(coords))
 
-        # Plot dots
-        for i, j in coords:
-            ax.plot(i, j, 'o', color=color, alpha=0.3, zorder=1)
+        # Collect team name at the end of the line
+        labels.append((coords[-1][-1], team_name, color, fontweight))
 
-        # Team name at the end of the line
-        ax.text(x=num_games-0.3, y=coords[-1][-1], s=team_name, va='center',
-                color=color, fontweight=fontweight, fontname='Rockwell')
+    ax.add_collection(PathCollection(paths, edgecolors=path_colors,
+                                     facecolors='none', zorder=5))
+    ax.scatter(xs, ys, c=dot_colors, alpha=0.3, zorder=1, rasterized=True)
+
+    font = FontProperties(family='Rockwell')
+    for y, team_name, color, fontweight in labels:
+        ax.text(x=num_games-0.3, y=y, s=team_name, va='center',
+                color=color, fontweight=fontweight, fontproperties=font)
 
     # Title
     if custom_title:
@@ -147,7 +243,7 @@ def draw_plot(league, season, standings, highlight_colors,
         title = f'{league_title} {season_title} Standings by Matchday'
 
     fig.text(x=0.5, y=0.84, s=title, color='w', fontsize=22,
-             fontweight='bold', fontname='Rockwell', ha='center')
+             fontweight='bold', fontproperties=font, ha='center')
 
     # Subtitle
     if subtitle and highlight_colors:
@@ -165,42 +261,50 @@ def draw_plot(league, season, standings, highlight_colors,
         fig_text(x=0.5, y=0.82, s=subtitle_text, color='w',
                  highlight_textprops=highlight_textprops, fontsize=18, ha='center', fontname='Rockwell')
 
-    # X-axis
-    ax.text(x=num_games/2, y=num_teams+0.5, s='Matchday',
-            fontsize=12, c='w', va='center', ha='center')
-
-    # Y-axis
-    ax.text(x=-1.25, y=num_teams/2, s='Position', rotation=90,
-            fontsize=12, c='w', va='bottom', ha='center')
+    # Axis labels
+    ax.set_xlabel('Matchday', fontsize=12, c='w')
+    ax.set_ylabel('Position', fontsize=12, c='w')
 
     # Axis configuration
-    ax.set_axis_off()
+    ax.patch.set_visible(False)
+    ax.spines[:].set_visible(False)
 
-    ax.set_xlim(-2, num_games+3)
+    ax.set_xlim(-0.75, num_games+3)
     if subtitle:
-        ax.set_ylim(-4, num_teams+1)
+        ax.set_ylim(-4, num_teams-0.25)
     else:
-        ax.set_ylim(-2.5, num_teams+1)
+        ax.set_ylim(-2.5, num_teams-0.25)
 
     ax.invert_yaxis()
 
     # Tick labels
-    x_labels = [ax.text(x=i-1, y=num_teams-0.25, s=i, ha='center',
-                        va='center', c='w', size=8)
-                for i in range(1, num_games+1)]
-
-    y_labels = [ax.text(x=-0.5, y=i, s=i+1, ha='center',
-                        va='center', c='w', size=8)
-                for i in range(num_teams)]
+    ax.tick_params(colors='w', labelsize=8, length=0)
+    ax.set_xticks(np.arange(num_games))
+    ax.set_xticklabels(np.arange(1, num_games+1))
+    ax.set_yticks(np.arange(num_teams))
+    ax.set_yticklabels(np.arange(1, num_teams+1))
 
     return fig
 
 
+@st.cache_data(max_entries=32, ttl=60*60, show_spinner=False)
+def render_png(league, season, standings, highlight_colors,
+               facecolor, custom_title, subtitle, aspect_ratio, dpi=100):
+    '''Returns the plot as PNG bytes, cached on the plot settings'''
+    fig = draw_plot(league, season, standings, highlight_colors,
+                    facecolor, custom_title, subtitle, aspect_ratio)
+    buffered = BytesIO()
+    fig.savefig(buffered, bbox_inches='tight', dpi=dpi)
+    plt.close(fig)
+    return buffered.getvalue()
+
+
 # ---------- Page setup ----------
 
 
 st.set_page_config(page_title='League Standings',
-                   page_icon='./static/favicon.ico')
+                   page_icon='./static/favicon.ico',
+                   layout='wide')
 
 
 # ---------- Change report view width ----------
@@ -208,14 +312,14 @@ st.set_page_config(page_title='League Standings',
 st.markdown(
     f"""
      <style>
-        .reportview-container .main .block-container{{
+        .main .block-container{{
             max-width: 1500px;
-            padding-top: 1re,;
-            padding-right: 1re,;
-            padding-left: 1re,;
-            padding-bottom: 1re,;
+            padding-top: 1rem;
+            padding-right: 1rem;
+            padding-left: 1rem;
+            padding-bottom: 1rem;
             }}
-        .reportview-container .main {{
+        [data-testid="stAppViewContainer"] .main {{
             background-color: #49505c;
             }}
     </style>
@@ -251,7 +355,9 @@ season_title = f'Selected season: {season-1}/{str(season)[2:]}'
 st.sidebar.write(season_title)
 
 # Initiate session
-session_state = SessionState.get(checkboxed=False)
+session_state = st.session_state
+if 'checkboxed' not in session_state:
+    session_state.checkboxed = False
 
 if st.sidebar.button('Gather data') or session_state.checkboxed:
     with st.spinner('Gathering data...'):
@@ -266,7 +372,8 @@ if session_state.checkboxed:
     st.sidebar.markdown('## Plot aesthetics')
 
     # Team selection
-    highlight_options = standings.values[:, -1]  # order of last matchday
+    # Order of last matchday
+    highlight_options = standings[max(standings.columns)].dropna()
     highlights = st.sidebar.multiselect(label='Highlight teams',
                                         options=highlight_options)
 
@@ -281,7 +388,7 @@ if session_state.checkboxed:
         color = st.sidebar.color_picker(label=team, value=value)
         colors.append(color)
 
-    highlight_colors = {i: c for i, c in zip(highlights, colors)}
+    highlight_colors = dict(zip(highlights, colors))
 
     # Titles
     st.sidebar.markdown('---')
@@ -309,48 +416,42 @@ if session_state.checkboxed:
 # ---------- Display plot ----------
 
 if session_state.checkboxed:
-    fig = draw_plot(league, season, standings, highlight_colors,
-                    facecolor, custom_title, subtitle)
+    plot_settings = (league, season, standings, highlight_colors,
+                     facecolor, custom_title, subtitle, aspect_ratio)
 
-    st.pyplot(fig)
+    st.image(render_png(*plot_settings), use_column_width=True)
 
 
 # ---------- Download links ----------
 
-def get_image_download_link(fig, filename):
-    """
-    (Adapted from https://discuss.streamlit.io/t/how-to-download-file-in-streamlit/1806)
-    Generates a link allowing the MPL image to be downloaded
-    in:  MPL image
-    out: href string
-    """
-    buffered = BytesIO()
-    fig.savefig(buffered, bbox_inches='tight', dpi=200)
-    b64 = base64.b64encode(buffered.getvalue()).decode()
-    href = f'<a href="data:file/png;base64,{b64}" download="{filename}.png">*download (.png)*</a>'
-    return href
-
-
-def get_table_download_link(df, filename):
+@st.cache_data(show_spinner=False)
+def get_table_bytes(df):
     """
-    (Adapted from https://discuss.streamlit.io/t/how-to-download-file-in-streamlit/1806)
-    Generates a link allowing the data in a given panda dataframe to be downloaded
+    Serializes the data in a given panda dataframe for st.download_button
     in:  dataframe
-    out: href string
+    out: CSV bytes
     """
-    csv = df.to_csv()
-    b64 = base64.b64encode(csv.encode()).decode()
-    href = f'<a href="data:file/csv;base64,{b64}" download="{filename}.csv">*download (.csv)*</a>'
-    return href
+    return df.to_csv().encode()
 
 
-if session_state.checkboxed and st.button('Generate download links'):
+# Keep the download buttons across the rerun triggered by clicking one of
+# them, but only for the plot settings they were generated for
+if 'downloads' not in session_state:
+    session_state.downloads = None
+
+if session_state.checkboxed:
+    # The standings follow from league and season, which are part of the key
+    download_key = plot_settings[:2] + plot_settings[3:]
+    if st.button('Generate download links'):
+        session_state.downloads = download_key
+    elif session_state.downloads != download_key:
+        session_state.downloads = None
+
+if session_state.checkboxed and session_state.downloads is not None:
     filename = f"{'-'.join(league.lower().split())}_{season}"
 
-    st.markdown(f'''
-                ### Downloads
-                * Image: {get_image_download_link(fig, filename)}
-                * Raw data:
-                {get_table_download_link(standings, filename)}
-                ''',
-                unsafe_allow_html=True)
+    st.markdown('### Downloads')
+    st.download_button('Image (.png)', data=render_png(*plot_settings, dpi=200),
+                       file_name=f'{filename}.png', mime='image/png')
+    st.download_button('Raw data (.csv)', data=get_table_bytes(standings),
+                       file_name=f'{filename}.csv', mime='text/csv')